@@ -6,13 +6,17 @@ dev = InputDevice('/dev/input/event0')
 print(dev)  # See device info
 print("Listening for touches...")
 
+# bind the codes we compare against to plain names once
+EV_ABS = ecodes.EV_ABS
+ABS_MT_POSITION_X = ecodes.ABS_MT_POSITION_X
+ABS_MT_POSITION_Y = ecodes.ABS_MT_POSITION_Y
+
+x = y = None
 for event in dev.read_loop():
-    if event.type == ecodes.EV_ABS:
-        if event.code == ecodes.ABS_MT_POSITION_X:
+    if event.type == EV_ABS:
+        if event.code == ABS_MT_POSITION_X:
             x = event.value
-        elif event.code == ecodes.ABS_MT_POSITION_Y:
+        elif event.code == ABS_MT_POSITION_Y:
             y = event.value
-        try:
+        if x is not None and y is not None:
             print(f"Touch at ({x}, {y})")
-        except NameError:
-            pass
@@ -0,0 +1,233 @@
+# cython: language_level=3, cdivision=True, boundscheck=False, wraparound=False
+"""
+touch_core.pyx
+
+Optional compiled event loop for touch_to_serial.py. Reads raw struct input_event
+records from the evdev fd, maps them to iPhone coordinates with integer math and
+writes "DOWN x y", "MOVE x y", "UP x y" lines to the output fd with write(2),
+all without holding the GIL. Behaviour matches the pure-Python loop (one MOVE per
+SYN_REPORT, --min-delta/--min-dt rate limit, --verbose echo to stdout), including
+its output backlog: bytes a non-blocking output can't take yet are kept and sent
+once it is writable again, trimmed to OUT_BUF_CAP with the same rule as
+touch_to_serial.trim_out() (oldest MOVEs first, never a half-sent line or a lone
+DOWN/UP).
+
+Build in place next to touch_to_serial.py, which picks it up automatically:
+  pip3 install cython
+  cythonize -i touch_core.pyx
+"""
+
+from libc.errno cimport errno, EINTR, EAGAIN, ENODEV
+from libc.stdio cimport snprintf
+from libc.stdlib cimport abs
+from libc.string cimport memchr, memmove, strerror
+from posix.unistd cimport read, write
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+from cpython.exc cimport PyErr_CheckSignals
+
+cdef extern from "<poll.h>" nogil:
+    struct pollfd:
+        int fd
+        short events
+        short revents
+    ctypedef unsigned long nfds_t
+    int poll(pollfd *fds, nfds_t nfds, int timeout)
+    enum:
+        POLLIN
+        POLLOUT
+
+cdef extern from "<linux/input.h>" nogil:
+    struct input_event:
+        unsigned short type
+        unsigned short code
+        int value
+    enum:
+        EV_SYN
+        EV_KEY
+        EV_ABS
+        SYN_REPORT
+        BTN_TOUCH
+        ABS_X
+        ABS_Y
+        ABS_MT_POSITION_X
+        ABS_MT_POSITION_Y
+
+cdef enum:
+    READ_EVENTS = 64                         # events pulled per read(2)
+    LINE_MAX = 32                            # longest line: "MOVE -2147483648 -2147483648\n"
+    BATCH_MAX = READ_EVENTS * LINE_MAX       # most output one read(2) can produce
+    OUT_BUF_CAP = 4096                       # same as touch_to_serial.OUT_BUF_CAP
+    PENDING_MAX = OUT_BUF_CAP + 2 * BATCH_MAX
+
+cdef struct loop_state:
+    bint touching
+    int cur_sx
+    int cur_sy
+    int last_tx
+    int last_ty
+    double last_emit
+    int npending                             # unsent output bytes in pending
+    char pending[PENDING_MAX]
+
+cdef inline double _now() noexcept nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+cdef int _trim(char *buf, int n) noexcept nogil:
+    """Shrink buf[:n] towards OUT_BUF_CAP like touch_to_serial.trim_out(); returns the new length."""
+    cdef char *nl
+    cdef char *nl2
+    cdef int head, src, dst, end, excess
+    if n <= OUT_BUF_CAP:
+        return n
+    nl = <char *>memchr(buf, b'\n', n)
+    if nl == NULL:
+        return n
+    # the first line may already be half-sent, so it always stays
+    head = nl - buf + 1
+
+    # pass 1: drop the oldest MOVE lines
+    excess = n - OUT_BUF_CAP
+    src = dst = head
+    while src < n:
+        nl = <char *>memchr(buf + src, b'\n', n - src)
+        end = nl - buf + 1 if nl != NULL else n
+        if excess > 0 and buf[src] == b'M' and nl != NULL:
+            excess -= end - src
+        else:
+            memmove(buf + dst, buf + src, end - src)
+            dst += end - src
+        src = end
+    n = dst
+
+    # pass 2: only DOWN/UP left; drop the oldest complete DOWN + UP pairs
+    excess = n - OUT_BUF_CAP
+    src = dst = head
+    while src < n:
+        nl = <char *>memchr(buf + src, b'\n', n - src)
+        end = nl - buf + 1 if nl != NULL else n
+        if excess > 0 and buf[src] == b'D' and end < n:
+            nl2 = <char *>memchr(buf + end, b'\n', n - end)
+            if nl2 != NULL:
+                excess -= nl2 - buf + 1 - src
+                src = nl2 - buf + 1
+                continue
+        memmove(buf + dst, buf + src, end - src)
+        dst += end - src
+        src = end
+    return dst
+
+cdef int _run(loop_state *st, int evfd, int outfd, int wakefd, int sxn, int sxd, int syn_, int syd,
+              int min_delta, double min_dt, bint echo) noexcept nogil:
+    """Run until a syscall fails; returns its errno (EINTR lets Python handle signals)."""
+    cdef input_event evs[READ_EVENTS]
+    cdef char *out = st.pending
+    cdef input_event *ev
+    cdef pollfd pfds[3]
+    cdef char drain[64]
+    cdef ssize_t n
+    cdef int i, nout, start, tx, ty
+    cdef double now
+
+    pfds[0].fd = evfd
+    # Python's signal handler only sets a flag and writes to the wakeup fd, so a
+    # signal that arrives outside poll()/read() is noticed through this pipe
+    pfds[1].fd = wakefd
+    pfds[1].events = POLLIN
+    pfds[2].fd = outfd
+    pfds[2].events = POLLOUT
+    while True:
+        # take more input only while a whole batch still fits behind the backlog;
+        # wait for the output to become writable only while there is a backlog
+        pfds[0].events = POLLIN if PENDING_MAX - st.npending >= BATCH_MAX else 0
+        if poll(pfds, 3 if st.npending else 2, -1) < 0:
+            return errno
+        if pfds[1].revents:
+            read(wakefd, drain, sizeof(drain))
+            return EINTR
+
+        if pfds[0].events and pfds[0].revents:
+            n = read(evfd, evs, sizeof(evs))
+            if n < 0:
+                if errno != EAGAIN:
+                    return errno
+                n = 0
+            elif n == 0:
+                return ENODEV
+
+            nout = st.npending
+            for i in range(<int>(n // sizeof(input_event))):
+                ev = &evs[i]
+                start = nout
+                # ABS events only update the current position
+                if ev.type == EV_ABS:
+                    if ev.code == ABS_X or ev.code == ABS_MT_POSITION_X:
+                        st.cur_sx = ev.value
+                    elif ev.code == ABS_Y or ev.code == ABS_MT_POSITION_Y:
+                        st.cur_sy = ev.value
+
+                # SYN_REPORT closes a frame: emit at most one (rate-limited) MOVE for it
+                elif ev.type == EV_SYN and ev.code == SYN_REPORT:
+                    if st.touching:
+                        tx = (st.cur_sx * sxn) // sxd
+                        ty = (st.cur_sy * syn_) // syd
+                        if tx != st.last_tx or ty != st.last_ty:
+                            now = _now()
+                            if abs(tx - st.last_tx) + abs(ty - st.last_ty) >= min_delta or now - st.last_emit >= min_dt:
+                                nout += snprintf(out + nout, LINE_MAX, "MOVE %d %d\n", tx, ty)
+                                st.last_tx = tx
+                                st.last_ty = ty
+                                st.last_emit = now
+
+                # BTN_TOUCH indicates press/release on many touch drivers
+                elif ev.type == EV_KEY and ev.code == BTN_TOUCH:
+                    tx = (st.cur_sx * sxn) // sxd
+                    ty = (st.cur_sy * syn_) // syd
+                    if ev.value == 1 and not st.touching:
+                        st.touching = True
+                        st.last_tx = tx
+                        st.last_ty = ty
+                        st.last_emit = _now()
+                        nout += snprintf(out + nout, LINE_MAX, "DOWN %d %d\n", tx, ty)
+                    elif ev.value == 0 and st.touching:
+                        st.touching = False
+                        nout += snprintf(out + nout, LINE_MAX, "UP %d %d\n", tx, ty)
+
+                if echo and nout > start:
+                    write(1, b"[OUT] ", 6)
+                    write(1, out + start, nout - start)
+            st.npending = nout
+
+        # one write for the whole backlog; keep whatever the output didn't take
+        if st.npending:
+            n = write(outfd, out, st.npending)
+            if n > 0:
+                st.npending -= <int>n
+                memmove(out, out + n, st.npending)
+            elif n < 0 and errno != EAGAIN and errno != EINTR:
+                return errno
+            st.npending = _trim(out, st.npending)
+
+def run_loop(int evfd, int outfd, int wakefd, int sxn, int sxd, int syn_, int syd,
+             int min_delta=2, double min_dt=0.008, bint echo=False):
+    """
+    Forward touch events from evfd to outfd until a read or write fails
+    (raised as OSError). wakefd is the read end of the signal.set_wakeup_fd()
+    pipe; when it becomes readable the pending Python signal handlers run, so
+    Ctrl-C and SIGTERM are delivered as usual.
+    """
+    cdef loop_state st
+    cdef int err
+    st.touching = False
+    st.cur_sx = st.cur_sy = 0
+    st.last_tx = st.last_ty = 0
+    st.last_emit = 0.0
+    st.npending = 0
+    while True:
+        with nogil:
+            err = _run(&st, evfd, outfd, wakefd, sxn, sxd, syn_, syd, min_delta, min_dt, echo)
+        if err == EINTR:
+            PyErr_CheckSignals()
+            continue
+        raise OSError(err, strerror(err).decode())
@@ -5,13 +5,18 @@ touch_to_serial_with_preview.py
 Reads touchscreen events (evdev), maps to target (IPHONE_W,IPHONE_H),
 and sends text messages "DOWN x y", "MOVE x y", "UP x y" over serial.
 
-If the configured SERIAL_PORT is not available, the script:
- - prints every outgoing line to stdout, and
- - opens a PTY pair and writes the same lines to the PTY master so you can monitor the slave device.
+If the configured SERIAL_PORT is not available, the script opens a PTY pair and
+writes the same lines to the PTY master so you can monitor the slave device.
+Pass --verbose to also print every outgoing line to stdout.
 
 Requirements:
   sudo apt install python3-pip
-  pip3 install evdev pyserial
+  pip3 install evdev
+
+Optional: build the compiled event loop next to this script and it is used
+automatically (see touch_core.pyx):
+  pip3 install cython
+  cythonize -i touch_core.pyx
 
 Run:
   sudo python3 touch_to_serial_with_preview.py
@@ -22,14 +27,21 @@ import sys
 import time
 import argparse
 import errno
+import selectors
+import struct
+import signal
+import queue
+import threading
+import _thread
 import pty
 import os
+import termios
 from evdev import InputDevice, list_devices, ecodes
 
 try:
-    import serial
-except Exception:
-    serial = None
+    import touch_core
+except ImportError:
+    touch_core = None
 
 # ---------- CONFIG (defaults; can pass via args) ----------
 DEFAULT_SERIAL = "/dev/ttyUSB0"
@@ -38,55 +50,215 @@ SCREEN_W = 800   # change to your touchscreen pixel width
 SCREEN_H = 480   # change to your touchscreen pixel height
 IPHONE_W = 828   # logical iPhone width (or choose arbitrary mapping)
 IPHONE_H = 1792  # logical iPhone height
+MIN_DELTA = 2    # MOVEs closer than this (Manhattan, iPhone px) to the last one...
+MIN_DT = 0.008   # ...and sooner than this many seconds after it are dropped
+OUT_FLUSH_BYTES = 256  # hand the output buffer to the writer early once it grows past this
+OUT_BUF_CAP = 4096     # max unsent bytes kept for a slow/unread output; oldest MOVEs go first
+WRITER_MAX_QUEUED = 8  # queued batches beyond this make the writer drop stale MOVE-only ones
+RT_PRIORITY = 20       # SCHED_FIFO priority used with --rt
+RT_NICE = -10          # fallback nice increment with --rt when SCHED_FIFO is not allowed
 # ---------------------------------------------------------
 
+# outgoing line formats, built straight to bytes (no str -> encode per event)
+DOWN_FMT = b"DOWN %d %d\n"
+MOVE_FMT = b"MOVE %d %d\n"
+UP_FMT = b"UP %d %d\n"
+OUT_PREFIX = b"[OUT] "  # --verbose echo prefix
+
+# raw struct input_event: a struct timeval (two native longs, which is also the
+# 32-bit kernel ABI) followed by __u16 type, __u16 code, __s32 value
+EVENT_FMT = struct.Struct("llHHi")
+EVENT_READ_BYTES = EVENT_FMT.size * 64  # events pulled per read(2)
+
+# lowercase substrings of device names that identify a touchscreen
+TOUCH_KEYWORDS = ("touch", "touchscreen", "goodix", "ft")
+
+# ABS code -> axis it updates; built once so the event loop does one dict lookup
+ABS_DISPATCH = {
+    ecodes.ABS_X: 'x',
+    ecodes.ABS_MT_POSITION_X: 'x',
+    ecodes.ABS_Y: 'y',
+    ecodes.ABS_MT_POSITION_Y: 'y',
+}
+
 def find_touch_device():
-    devices = [InputDevice(path) for path in list_devices()]
-    # heuristics: name contains 'touch' or capabilities include ABS_X/ABS_Y
-    for d in devices:
-        name = d.name.lower()
-        if "touch" in name or "touchscreen" in name or "goodix" in name or "ft" in name:
+    # enumerate once; names are lowercased once and reused by both passes
+    devices = [(d, d.name.lower()) for d in (InputDevice(path) for path in list_devices())]
+    chosen = None
+    # heuristics: name contains a touch keyword or capabilities include ABS_X/ABS_Y
+    for d, name in devices:
+        if any(k in name for k in TOUCH_KEYWORDS):
             print(f"[touch] chosen by name: {d.path} -> {d.name}")
-            return d
+            chosen = d
+            break
     # fallback: find device with ABS_X/ABS_Y or ABS_MT_POSITION_X/Y
-    for d in devices:
-        caps = d.capabilities()
-        if any(code in caps for code in (ecodes.ABS_X, ecodes.ABS_Y, ecodes.ABS_MT_POSITION_X, ecodes.ABS_MT_POSITION_Y)):
-            print(f"[touch] chosen by capability: {d.path} -> {d.name}")
-            return d
-    print("[touch] no touchscreen input device found. Devices discovered:")
-    for d in devices:
-        print("  ", d.path, "-", d.name)
-    raise FileNotFoundError("No touchscreen device found. Check `ls /dev/input` and run this as root or add udev rules.")
+    if chosen is None:
+        for d, _ in devices:
+            abs_codes = d.capabilities(absinfo=False).get(ecodes.EV_ABS, ())
+            if any(code in abs_codes for code in ABS_DISPATCH):
+                print(f"[touch] chosen by capability: {d.path} -> {d.name}")
+                chosen = d
+                break
+    if chosen is None:
+        print("[touch] no touchscreen input device found. Devices discovered:")
+        for d, _ in devices:
+            print("  ", d.path, "-", d.name)
+    # don't leak the fds of the devices we are not going to use
+    for d, _ in devices:
+        if d is not chosen:
+            d.close()
+    if chosen is None:
+        raise FileNotFoundError("No touchscreen device found. Check `ls /dev/input` and run this as root or add udev rules.")
+    return chosen
+
+def open_raw_tty(path, baud):
+    """
+    Open path as a raw (8N1, no line processing, no flow control) write-only
+    tty at baud and return its non-blocking fd.
+    """
+    speed = getattr(termios, f"B{baud}", None)
+    if speed is None:
+        raise ValueError(f"unsupported baud rate {baud}")
+    fd = os.open(path, os.O_WRONLY | os.O_NOCTTY | os.O_NONBLOCK)
+    try:
+        attrs = termios.tcgetattr(fd)
+        attrs[0] = 0                                              # iflag
+        attrs[1] = 0                                              # oflag: no \n -> \r\n
+        attrs[2] = termios.CS8 | termios.CREAD | termios.CLOCAL  # cflag
+        attrs[3] = 0                                              # lflag
+        attrs[4] = attrs[5] = speed                               # ispeed, ospeed
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
 
 def open_serial_or_pty(serial_port, baud):
     """
-    Try to open a real serial.Serial; if fail, return (None, pty_slave_path, master_fd)
-    If success, return (serial_obj, None, None)
+    Try to open serial_port as a raw tty; if that fails fall back to a PTY.
+    Returns (out_fd, pty_slave_name); pty_slave_name is None for a real serial port.
     """
-    if serial is None:
-        print("[serial] pyserial not available; falling back to PTY/print.")
-        return None, create_pty_and_report()
     try:
-        s = serial.Serial(serial_port, baud, timeout=0)
+        fd = open_raw_tty(serial_port, baud)
         print(f"[serial] opened {serial_port} @ {baud}")
-        return s, None, None
+        return fd, None
     except Exception as e:
-        print(f"[serial] failed to open {serial_port}: {e}. Falling back to PTY + stdout preview.")
-        return None, create_pty_and_report()
+        print(f"[serial] failed to open {serial_port}: {e}. Falling back to PTY.")
+        slave_name, master_fd = create_pty_and_report()
+        return master_fd, slave_name
 
 def create_pty_and_report():
     master_fd, slave_fd = pty.openpty()
     slave_name = os.ttyname(slave_fd)
+    # non-blocking so a PTY nobody is reading can never stall the touch loop
+    os.set_blocking(master_fd, False)
     print(f"[pty] created PTY. You can monitor output with: cat {slave_name}  (or use screen/minicom on the slave).")
     # We'll write to master_fd.
     return (slave_name, master_fd)
 
-def map_coords(sx, sy, screen_w, screen_h, iphone_w, iphone_h):
-    # simple linear map (assumes mirrored video is full-screen and non-cropped)
-    tx = int(sx * (iphone_w / screen_w))
-    ty = int(sy * (iphone_h / screen_h))
-    return tx, ty
+def trim_out(out_buf):
+    """
+    Shrink an unsent backlog back to OUT_BUF_CAP. The first line is never
+    touched (it may already be half-sent). Oldest MOVE lines go first; only
+    if none are left are the oldest complete DOWN + UP pairs dropped, so the
+    receiver never sees a lone DOWN or UP.
+    """
+    head = out_buf.find(b"\n") + 1
+    while len(out_buf) > OUT_BUF_CAP:
+        i = out_buf.find(b"MOVE", head)
+        if i >= 0:
+            del out_buf[i:out_buf.index(b"\n", i) + 1]
+            continue
+        # only DOWN/UP lines left; with no MOVEs, the line after a DOWN is its UP
+        i = out_buf.find(b"DOWN", head)
+        end = out_buf.find(b"\n", out_buf.index(b"\n", i) + 1) if i >= 0 else -1
+        if end < 0:
+            break
+        del out_buf[i:end + 1]
+
+def flush_out(out_buf, out_fd):
+    """
+    Write everything buffered in out_buf with a single os.write() to the
+    (non-blocking) serial port or PTY master, and remove what was sent.
+    Bytes the output can't take right now stay in out_buf, which trim_out()
+    keeps within OUT_BUF_CAP (stale MOVEs are safe to lose).
+    Any other write error (e.g. the serial adapter was unplugged) is raised.
+    """
+    try:
+        del out_buf[:os.write(out_fd, out_buf)]
+    except BlockingIOError:
+        # the other side isn't reading (fast enough); keep the bytes for the next try
+        pass
+    if len(out_buf) > OUT_BUF_CAP:
+        trim_out(out_buf)
+
+def set_realtime_priority(priority):
+    """
+    Put the calling thread (and threads it starts afterwards) on SCHED_FIFO at
+    priority, so touch forwarding preempts other Pi tasks. Falls back to
+    nice(RT_NICE), and to normal scheduling if neither is permitted.
+    """
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        print(f"[rt] running SCHED_FIFO priority {priority}")
+        return
+    except (PermissionError, AttributeError) as e:
+        print(f"[rt] SCHED_FIFO not available: {e}")
+    try:
+        os.nice(RT_NICE)
+        print(f"[rt] running at nice {RT_NICE}")
+    except PermissionError:
+        print("[rt] not permitted to raise priority (run as root); using normal priority")
+
+def writer_loop(q, out_fd, kick_r, waiting, errors):
+    """
+    Writer thread: take batches of lines from q and write them to out_fd, so the
+    touch reader never waits on the UART/PTY. Everything already queued goes
+    out in one write; when more than WRITER_MAX_QUEUED batches are waiting,
+    MOVE-only batches other than the newest are dropped (a late MOVE is
+    worthless, a lost DOWN/UP is not). With a backlog it sleeps, with no
+    timeout, until out_fd is writable or the reader writes to kick_r (which it
+    does only while waiting is set). A None item stops the thread after a
+    final flush. A hard write error is appended to errors and interrupts the
+    main thread, which re-raises it.
+    """
+    pending = bytearray()
+    wsel = selectors.DefaultSelector()
+    wsel.register(out_fd, selectors.EVENT_WRITE)
+    wsel.register(kick_r, selectors.EVENT_READ)
+    stop = False
+    while not stop:
+        if pending:
+            # backlog: sleep until the output can take more or new lines are queued;
+            # waiting is set before the emptiness check so a put can't slip past us
+            waiting.set()
+            if q.empty():
+                for key, _ in wsel.select():
+                    if key.fd == kick_r:
+                        os.read(kick_r, 512)
+            waiting.clear()
+            batches = []
+        else:
+            batches = [q.get()]
+        while True:
+            try:
+                batches.append(q.get_nowait())
+            except queue.Empty:
+                break
+        if None in batches:
+            stop = True
+            batches = batches[:batches.index(None)]
+        if len(batches) > WRITER_MAX_QUEUED:
+            batches = [b for b in batches[:-1] if b"DOWN" in b or b"UP" in b] + batches[-1:]
+        for b in batches:
+            pending += b
+        try:
+            flush_out(pending, out_fd)
+        except OSError as e:
+            errors.append(e)
+            _thread.interrupt_main()
+            break
+    wsel.close()
 
 def main():
     parser = argparse.ArgumentParser()
@@ -96,6 +268,10 @@ def main():
     parser.add_argument("--screen-h", type=int, default=SCREEN_H)
     parser.add_argument("--iphone-w", type=int, default=IPHONE_W)
     parser.add_argument("--iphone-h", type=int, default=IPHONE_H)
+    parser.add_argument("--min-delta", type=int, default=MIN_DELTA, help="Minimum MOVE distance in iPhone pixels (unless --min-dt has passed)")
+    parser.add_argument("--min-dt", type=float, default=MIN_DT, help="Minimum seconds between MOVEs (unless --min-delta was exceeded)")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Echo every outgoing line to stdout")
+    parser.add_argument("--rt", action="store_true", help="Run the event loop SCHED_FIFO (or at raised nice) for lower latency; needs root")
     args = parser.parse_args()
 
     try:
@@ -104,105 +280,166 @@ def main():
         print(e)
         sys.exit(1)
 
-    serial_obj, pty_info, master_fd = None, None, None
-    # open serial or fallback
-    result = open_serial_or_pty(args.serial, args.baud)
-    if isinstance(result[0], object) and result[0] is not None:
-        serial_obj = result[0]
-    else:
-        # fallback: result == (None, (slave_name, master_fd))
-        pty_info = result[1]
-        # pty_info is a tuple (slave_name, master_fd) returned by create_pty_and_report()
-        if isinstance(pty_info, tuple):
-            slave_name, master_fd = pty_info
-        else:
-            # compatibility: create_pty_and_report previously returned (slave_name, master_fd)
-            slave_name, master_fd = pty_info
+    # open serial or fallback; either way the output is a plain non-blocking fd
+    out_fd, _ = open_serial_or_pty(args.serial, args.baud)
 
     print(f"[info] using touch device {dev.path} ({dev.name})")
     print(f"[info] mapping screen {args.screen_w}x{args.screen_h} -> iPhone {args.iphone_w}x{args.iphone_h}")
     print("[info] starting event loop. Ctrl-C to quit.")
 
+    # scale factors for the linear screen -> iPhone map (assumes mirrored video
+    # is full-screen and non-cropped); integer math keeps floats out of the loop
+    sxn, sxd = args.iphone_w, args.screen_w
+    syn_, syd = args.iphone_h, args.screen_h
+    # the rest of the config the loop reads, as plain locals rather than args.<attr>
+    min_delta, min_dt, verbose = args.min_delta, args.min_dt, args.verbose
+
     # state
     touching = False
     cur_sx = cur_sy = 0
     last_tx = last_ty = None
+    last_emit = 0.0
+    # outgoing lines are batched and handed to the writer once per drained batch of events
+    out_buf = bytearray()
+    out_q = queue.SimpleQueue()
+    writer = None
+    # a write error the writer thread hit; main re-raises it instead of a clean exit
+    write_errors = []
+    # while the writer sleeps on a backed-up output, the reader wakes it via this pipe
+    kick_r, kick_w = os.pipe()
+    writer_waiting = threading.Event()
+
+    # evdev opens devices O_NONBLOCK; read blocking instead and let the selector
+    # sleep with no timeout, so we wake exactly when events arrive (0% CPU idle)
+    os.set_blocking(dev.fd, True)
+    sel = selectors.DefaultSelector()
+    sel.register(dev.fileno(), selectors.EVENT_READ)
+    # signals may land on the writer thread, or arrive while the compiled loop is
+    # outside a syscall; the wakeup pipe still gets the untimed wait back to
+    # Python so the KeyboardInterrupt can be raised
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    sel.register(wake_r, selectors.EVENT_READ)
+
+    if args.rt:
+        # before the writer thread starts, so it inherits the policy too
+        set_realtime_priority(RT_PRIORITY)
+    if touch_core is not None:
+        print("[info] using compiled touch_core event loop")
+    # both loops echo with raw writes to fd 1, so get buffered prints out first
+    sys.stdout.flush()
+
+    # aliases: bind everything the hot loop touches to locals once, so each event
+    # costs LOAD_FAST instead of LOAD_GLOBAL + LOAD_ATTR chains
+    EV_ABS, EV_KEY, EV_SYN = ecodes.EV_ABS, ecodes.EV_KEY, ecodes.EV_SYN
+    SYN_REPORT, BTN_TOUCH = ecodes.SYN_REPORT, ecodes.BTN_TOUCH
+    down_fmt, move_fmt, up_fmt, out_prefix = DOWN_FMT, MOVE_FMT, UP_FMT, OUT_PREFIX
+    abs_axis = ABS_DISPATCH.get
+    iter_events = EVENT_FMT.iter_unpack
+    read, writev, monotonic = os.read, os.writev, time.monotonic
+    enqueue = out_q.put
+    write, must_kick = os.write, writer_waiting.is_set
+    abs_, len_, bytes_ = abs, len, bytes
+    flush_bytes, read_bytes = OUT_FLUSH_BYTES, EVENT_READ_BYTES
+    dev_fd = dev.fd
 
     try:
-        for ev in dev.read_loop():
-            # ABS events give coordinates
-            if ev.type == ecodes.EV_ABS:
-                code = ev.code
-                if code in (ecodes.ABS_MT_POSITION_X, ecodes.ABS_X):
-                    cur_sx = ev.value
-                elif code in (ecodes.ABS_MT_POSITION_Y, ecodes.ABS_Y):
-                    cur_sy = ev.value
-
-                # if we already have an active touch, emit MOVE
-                if touching:
-                    tx, ty = map_coords(cur_sx, cur_sy, args.screen_w, args.screen_h, args.iphone_w, args.iphone_h)
-                    if tx != last_tx or ty != last_ty:
-                        line = f"MOVE {tx} {ty}\n"
-                        # write to serial or PTY/master and print
-                        if serial_obj:
-                            try:
-                                serial_obj.write(line.encode('ascii'))
-                            except Exception as e:
-                                print("[serial] write failed:", e)
-                                serial_obj = None
-                        else:
-                            # write to PTY master to simulate serial device
-                            try:
-                                os.write(master_fd, line.encode('ascii'))
-                            except Exception as e:
-                                # sometimes the other side isn't reading; ignore
-                                pass
-                        # always print to stdout for debug
-                        print("[OUT]", line.strip())
-                        last_tx, last_ty = tx, ty
+        if touch_core is not None:
+            # compiled fast path: the whole event loop runs in C without the GIL
+            touch_core.run_loop(dev.fd, out_fd, wake_r, sxn, sxd, syn_, syd, min_delta, min_dt, verbose)
+            return
+
+        # writes happen on their own thread so a slow UART never blocks the reader
+        writer = threading.Thread(target=writer_loop, args=(out_q, out_fd, kick_r, writer_waiting, write_errors), name="writer", daemon=True)
+        writer.start()
+
+        while True:
+            ready = [key.fd for key, _ in sel.select()]
+            if wake_r in ready:
+                read(wake_r, 64)
+            if dev_fd not in ready:
+                continue
+            # one blocking read(2) per wake; a longer backlog just wakes us again
+            for _, _, etype, ecode, evalue in iter_events(read(dev_fd, read_bytes)):
+                # ABS events only update the current position
+                if etype == EV_ABS:
+                    axis = abs_axis(ecode)
+                    if axis == 'x':
+                        cur_sx = evalue
+                    elif axis == 'y':
+                        cur_sy = evalue
+
+                # SYN_REPORT closes a frame: emit at most one MOVE for it
+                elif etype == EV_SYN and ecode == SYN_REPORT:
+                    if touching:
+                        tx = (cur_sx * sxn) // sxd
+                        ty = (cur_sy * syn_) // syd
+                        if tx != last_tx or ty != last_ty:
+                            # rate limit: skip tiny moves that follow the last one too closely;
+                            # UP always carries the final position so nothing is lost on release
+                            now = monotonic()
+                            if abs_(tx - last_tx) + abs_(ty - last_ty) >= min_delta or now - last_emit >= min_dt:
+                                line = move_fmt % (tx, ty)
+                                out_buf += line
+                                if verbose:
+                                    writev(1, (out_prefix, line))
+                                last_tx, last_ty = tx, ty
+                                last_emit = now
+                    if len_(out_buf) >= flush_bytes:
+                        enqueue(bytes_(out_buf))
+                        out_buf.clear()
+                        if must_kick():
+                            write(kick_w, b"\0")
 
-            # KEY events: BTN_TOUCH indicates press/release on many touch drivers
-            elif ev.type == ecodes.EV_KEY and ev.code == ecodes.BTN_TOUCH:
-                val = ev.value
-                tx, ty = map_coords(cur_sx, cur_sy, args.screen_w, args.screen_h, args.iphone_w, args.iphone_h)
-                if val == 1 and not touching:
-                    touching = True
-                    last_tx, last_ty = tx, ty
-                    line = f"DOWN {tx} {ty}\n"
-                elif val == 0 and touching:
-                    touching = False
-                    line = f"UP {tx} {ty}\n"
-                    last_tx = last_ty = None
-                else:
-                    line = None
-
-                if line:
-                    if serial_obj:
-                        try:
-                            serial_obj.write(line.encode('ascii'))
-                        except Exception as e:
-                            print("[serial] write failed:", e)
-                            serial_obj = None
+                # KEY events: BTN_TOUCH indicates press/release on many touch drivers
+                elif etype == EV_KEY and ecode == BTN_TOUCH:
+                    tx = (cur_sx * sxn) // sxd
+                    ty = (cur_sy * syn_) // syd
+                    if evalue == 1 and not touching:
+                        touching = True
+                        last_tx, last_ty = tx, ty
+                        last_emit = monotonic()
+                        line = down_fmt % (tx, ty)
+                    elif evalue == 0 and touching:
+                        touching = False
+                        line = up_fmt % (tx, ty)
+                        last_tx = last_ty = None
                     else:
-                        try:
-                            os.write(master_fd, line.encode('ascii'))
-                        except Exception:
-                            pass
-                    print("[OUT]", line.strip())
-            # optional: map BTN_TOOL_* or SYN events if needed
+                        line = None
+
+                    if line:
+                        out_buf += line
+                        if verbose:
+                            writev(1, (out_prefix, line))
+                # optional: map BTN_TOOL_* events if needed
+            if out_buf:
+                enqueue(bytes_(out_buf))
+                out_buf.clear()
+                if must_kick():
+                    write(kick_w, b"\0")
     except KeyboardInterrupt:
+        if write_errors:
+            # not a Ctrl-C: the output died, so fail like a write error in this thread would
+            raise write_errors[0] from None
         print("\n[info] exiting")
     finally:
-        if serial_obj:
-            try:
-                serial_obj.close()
-            except:
-                pass
-        if master_fd:
-            try:
-                os.close(master_fd)
-            except:
-                pass
+        sel.close()
+        signal.set_wakeup_fd(-1)
+        os.close(wake_r)
+        os.close(wake_w)
+        if writer is not None:
+            # let the writer push out what is still queued (e.g. a final UP)
+            out_q.put(None)
+            os.write(kick_w, b"\0")
+            writer.join(timeout=1.0)
+        os.close(kick_r)
+        os.close(kick_w)
+        try:
+            os.close(out_fd)
+        except:
+            pass
 
 if __name__ == "__main__":
     main()